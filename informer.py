@@ -7,6 +7,7 @@ from .models.encoder import Encoder, EncoderLayer, ConvLayer, EncoderStack
 from .models.decoder import Decoder, DecoderLayer
 from .models.attn import FullAttention, ProbAttention, AttentionLayer
 from .models.embed import DataEmbedding
+from .utils.tools import upgrade_state_dict
 
 from ..libs import manager
 
@@ -16,7 +17,7 @@ class Informer(nn.Layer):
                 factor=5, d_model=512, n_heads=8, e_layers=3, d_layers=2, d_ff=512,
                 dropout=0.0, attn='prob', embed='fixed', freq='h', activation='gelu',
                 output_attention = False, distil=True, mix=True,
-                device='cuda:0'):
+                device='cuda:0', to_static=False, amp_dtype=None):
         super(Informer, self).__init__()
         self.pred_len = out_len
         self.attn = attn
@@ -31,7 +32,7 @@ class Informer(nn.Layer):
         self.encoder = Encoder(
             [
                 EncoderLayer(
-                    AttentionLayer(Attn(False, factor, attention_dropout=dropout, output_attention=output_attention),
+                    AttentionLayer(Attn(False, factor, attention_dropout=dropout, output_attention=output_attention, amp_dtype=amp_dtype),
                                 d_model, n_heads, mix=False),
                     d_model,
                     d_ff,
@@ -50,9 +51,9 @@ class Informer(nn.Layer):
         self.decoder = Decoder(
             [
                 DecoderLayer(
-                    AttentionLayer(Attn(True, factor, attention_dropout=dropout, output_attention=False),
+                    AttentionLayer(Attn(True, factor, attention_dropout=dropout, output_attention=False, amp_dtype=amp_dtype),
                                 d_model, n_heads, mix=mix),
-                    AttentionLayer(FullAttention(False, factor, attention_dropout=dropout, output_attention=False),
+                    AttentionLayer(FullAttention(False, factor, attention_dropout=dropout, output_attention=False, amp_dtype=amp_dtype),
                                 d_model, n_heads, mix=False),
                     d_model,
                     d_ff,
@@ -67,6 +68,16 @@ class Informer(nn.Layer):
         # self.end_conv2 = nn.Conv1d(in_channels=d_model, out_channels=c_out, kernel_size=1, bias_attr=True)
         self.projection = nn.Linear(d_model, c_out, bias_attr=True)
 
+        if to_static:
+            # compile the inner attentions so paddle can fuse their small elementwise ops
+            for layer in self.sublayers():
+                if isinstance(layer, AttentionLayer):
+                    layer.inner_attention = paddle.jit.to_static(layer.inner_attention, full_graph=True)
+
+    def set_state_dict(self, state_dict, use_structured_name=True):
+        # also accept checkpoints saved before the fused key/value projections / temporal table
+        return super(Informer, self).set_state_dict(upgrade_state_dict(self, state_dict), use_structured_name)
+
     def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec,
                 enc_self_mask=None, dec_self_mask=None, dec_enc_mask=None):
         enc_out = self.enc_embedding(x_enc, x_mark_enc)
@@ -90,7 +101,7 @@ class InformerStack(nn.Layer):
                 factor=5, d_model=512, n_heads=8, e_layers=[3,2,1], d_layers=2, d_ff=512,
                 dropout=0.0, attn='prob', embed='fixed', freq='h', activation='gelu',
                 output_attention = False, distil=True, mix=True,
-                device='cuda:0'):
+                device='cuda:0', to_static=False, amp_dtype=None):
         super(InformerStack, self).__init__()
         self.pred_len = out_len
         self.attn = attn
@@ -108,7 +119,7 @@ class InformerStack(nn.Layer):
             Encoder(
                 [
                     EncoderLayer(
-                        AttentionLayer(Attn(False, factor, attention_dropout=dropout, output_attention=output_attention),
+                        AttentionLayer(Attn(False, factor, attention_dropout=dropout, output_attention=output_attention, amp_dtype=amp_dtype),
                                     d_model, n_heads, mix=False),
                         d_model,
                         d_ff,
@@ -128,9 +139,9 @@ class InformerStack(nn.Layer):
         self.decoder = Decoder(
             [
                 DecoderLayer(
-                    AttentionLayer(Attn(True, factor, attention_dropout=dropout, output_attention=False),
+                    AttentionLayer(Attn(True, factor, attention_dropout=dropout, output_attention=False, amp_dtype=amp_dtype),
                                 d_model, n_heads, mix=mix),
-                    AttentionLayer(FullAttention(False, factor, attention_dropout=dropout, output_attention=False),
+                    AttentionLayer(FullAttention(False, factor, attention_dropout=dropout, output_attention=False, amp_dtype=amp_dtype),
                                 d_model, n_heads, mix=False),
                     d_model,
                     d_ff,
@@ -145,6 +156,16 @@ class InformerStack(nn.Layer):
         # self.end_conv2 = nn.Conv1d(in_channels=d_model, out_channels=c_out, kernel_size=1, bias_attr=True)
         self.projection = nn.Linear(d_model, c_out, bias_attr=True)
 
+        if to_static:
+            # compile the inner attentions so paddle can fuse their small elementwise ops
+            for layer in self.sublayers():
+                if isinstance(layer, AttentionLayer):
+                    layer.inner_attention = paddle.jit.to_static(layer.inner_attention, full_graph=True)
+
+    def set_state_dict(self, state_dict, use_structured_name=True):
+        # also accept checkpoints saved before the fused key/value projections / temporal table
+        return super(InformerStack, self).set_state_dict(upgrade_state_dict(self, state_dict), use_structured_name)
+
     def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec,
                 enc_self_mask=None, dec_self_mask=None, dec_enc_mask=None):
         enc_out = self.enc_embedding(x_enc, x_mark_enc)
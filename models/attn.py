@@ -4,34 +4,75 @@ import paddle.nn.functional as F
 
 import numpy as np
 
-from math import sqrt
-from ..utils.masking import TriangularCausalMask, ProbMask
-from ..utils.tools import swap_shape
+from math import sqrt, log, ceil
+from ..utils.masking import TriangularCausalMask, ProbMask, prob_mask_base
+from ..utils.tools import xavier_uniform
+
+
+def _cached(cache, key, build):
+    # only eager tensors are reused across calls; under paddle.jit.to_static the
+    # built value belongs to the traced program and is folded into it instead
+    if not paddle.in_dynamic_mode():
+        return build()
+    if key not in cache:
+        cache[key] = build()
+    return cache[key]
+
+def _check_amp_dtype(amp_dtype):
+    # fail at construction instead of with a missing matmul kernel deep in forward
+    if amp_dtype is None:
+        return None
+    if amp_dtype not in ('float16', 'bfloat16'):
+        raise ValueError("amp_dtype must be None, 'float16' or 'bfloat16', got {!r}".format(amp_dtype))
+    if paddle.device.get_device() == 'cpu':
+        raise ValueError("amp_dtype={!r} needs a GPU place, paddle has no reduced precision "
+                         "matmul kernels on CPU".format(amp_dtype))
+    return amp_dtype
+
+def _matmul(x, y, amp_dtype=None, transpose_y=False):
+    # with amp_dtype (e.g. 'bfloat16') the matmul runs in reduced precision and the
+    # result is cast back, so masking and softmax stay in the input dtype
+    if amp_dtype is None:
+        return paddle.matmul(x, y, transpose_y=transpose_y)
+    return paddle.matmul(x.cast(amp_dtype), y.cast(amp_dtype), transpose_y=transpose_y).cast(x.dtype)
+
+def _einsum(equation, x, y, amp_dtype=None):
+    # same as _matmul, for the einsum contractions
+    if amp_dtype is None:
+        return paddle.einsum(equation, x, y)
+    return paddle.einsum(equation, x.cast(amp_dtype), y.cast(amp_dtype)).cast(x.dtype)
 
 
 class FullAttention(nn.Layer):
-    def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False):
+    # takes [B, L, H, E] inputs, einsum needs no head-major copies
+    heads_first = False
+
+    def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False, amp_dtype=None):
         super(FullAttention, self).__init__()
         self.scale = scale
+        self.amp_dtype = _check_amp_dtype(amp_dtype)
         self.mask_flag = mask_flag
         self.output_attention = output_attention
         self.dropout = nn.Dropout(attention_dropout)
+        # causal masks keyed by L, built with batch 1 and broadcast over B and H
+        self._causal_cache = {}
 
     def forward(self, queries, keys, values, attn_mask):
         B, L, H, E = queries.shape
-        _, S, _, D = values.shape
         scale = self.scale or 1./sqrt(E)
 
-        scores = paddle.einsum("blhe,bshe->bhls", queries, keys)
+        # fold the scale into Q so the scores need no extra elementwise pass
+        scores = _einsum("blhe,bshe->bhls", queries * scale, keys, self.amp_dtype)
         if self.mask_flag:
             if attn_mask is None:
-                attn_mask = TriangularCausalMask(B, L, device=paddle.device.get_device())
+                attn_mask = _cached(self._causal_cache, L,
+                                    lambda: TriangularCausalMask(1, L, device=paddle.device.get_device()))
 
             # scores.masked_fill_(attn_mask.mask, -np.inf)
-            scores = paddle.where(attn_mask.mask.tile([1,H,1,1]), -np.inf*paddle.ones_like(scores), scores)
+            scores = paddle.where(attn_mask.mask, paddle.full([], -np.inf, dtype=scores.dtype), scores)
 
-        A = self.dropout(F.softmax(scale * scores, axis=-1))
-        V = paddle.einsum("bhls,bshd->blhd", A, values)
+        A = self.dropout(F.softmax(scores, axis=-1))
+        V = _einsum("bhls,bshd->blhd", A, values, self.amp_dtype)
 
         if self.output_attention:
             return (V, A)
@@ -39,36 +80,39 @@ class FullAttention(nn.Layer):
             return (V, None)
 
 class ProbAttention(nn.Layer):
-    def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False):
+    # takes [B, H, L, D] inputs, the top-k gathers and scatters run along axis 2
+    heads_first = True
+
+    def __init__(self, mask_flag=True, factor=5, scale=None, attention_dropout=0.1, output_attention=False, amp_dtype=None):
         super(ProbAttention, self).__init__()
         self.factor = factor
         self.scale = scale
+        self.amp_dtype = _check_amp_dtype(amp_dtype)
         self.mask_flag = mask_flag
         self.output_attention = output_attention
         self.dropout = nn.Dropout(attention_dropout)
+        # upper-triangular ProbMask bases keyed by (L_Q, L_K)
+        self._mask_cache = {}
 
-    def _prob_QK(self, Q, K, sample_k, n_top): # n_top: c*ln(L_q)
+    def _prob_QK(self, Q, K, sample_k, n_top, scale=1.): # n_top: c*ln(L_q)
         # Q [B, H, L, D]
         B, H, L_K, E = K.shape
         _, _, L_Q, _ = Q.shape
 
         # calculate the sampled Q_K
-        K_expand = K.unsqueeze(-3).expand([B, H, L_Q, L_K, E])
         index_sample = paddle.randint(high=L_K, shape=[L_Q, sample_k]) # real U = U_part(factor*ln(L_k))*L_q
-        index_sample = index_sample.reshape([1,1,L_Q, sample_k, 1]).tile([B, H, 1, 1, E])
-        # K_sample = K_expand[:, :, paddle.arange(L_Q).unsqueeze(1), index_sample, :]
-        K_sample = K_expand.index_sample(index_sample)
-        Q_K_sample = paddle.matmul(Q.unsqueeze(-2), K_sample.transpose(-2, -1)).squeeze(-2)
+        # gather the sampled keys of every query straight from K: [B, H, L_Q, sample_k, E]
+        K_sample = paddle.index_select(K, index_sample.reshape([-1]), axis=2).reshape([B, H, L_Q, sample_k, E])
+        Q_K_sample = _matmul(Q.unsqueeze(-2), K_sample, self.amp_dtype, transpose_y=True).squeeze(-2)
 
         # find the Top_k query with sparisty measurement
-        M = Q_K_sample.max(-1)[0] - paddle.div(Q_K_sample.sum(-1), L_K)
+        # paddle's max returns the values only (no torch-style (values, indices) tuple)
+        M = Q_K_sample.max(axis=-1) - Q_K_sample.sum(axis=-1) / L_K
         M_top = M.topk(n_top, sorted=False)[1]
 
-        # use the reduced Q to calculate Q_K
-        Q_reduce = Q[paddle.arange(B)[:, None, None],
-                     paddle.arange(H)[None, :, None],
-                     M_top, :] # factor*ln(L_q)
-        Q_K = paddle.matmul(Q_reduce, K.transpose(-2, -1)) # factor*ln(L_q)*L_k
+        # use the reduced Q to calculate Q_K, the scale is folded into Q_reduce
+        Q_reduce = paddle.take_along_axis(Q, M_top.unsqueeze(-1), axis=2) * scale # factor*ln(L_q)
+        Q_K = _matmul(Q_reduce, K, self.amp_dtype, transpose_y=True) # factor*ln(L_q)*L_k
 
         return Q_K, M_top
 
@@ -76,8 +120,9 @@ class ProbAttention(nn.Layer):
         B, H, L_V, D = V.shape
         if not self.mask_flag:
             # V_sum = V.sum(dim=-2)
-            V_sum = V.mean(axis=-2)
-            contex = V_sum.unsqueeze(-2).expand([B, H, L_Q, V_sum.shape[-1]]).clone()
+            V_sum = V.mean(axis=-2, keepdim=True)
+            # paddle's expand already writes a new tensor, no clone needed
+            contex = V_sum.expand([B, H, L_Q, D])
         else: # use mask
             assert(L_Q == L_V) # requires that L_Q == L_V, i.e. for self-attention only
             contex = V.cumsum(axis=-2)
@@ -87,47 +132,44 @@ class ProbAttention(nn.Layer):
         B, H, L_V, D = V.shape
 
         if self.mask_flag:
-            attn_mask = ProbMask(B, H, L_Q, index, scores, device=paddle.device.get_device())
+            mask_base = _cached(self._mask_cache, (L_Q, L_V),
+                                lambda: prob_mask_base(L_Q, L_V))
+            attn_mask = ProbMask(B, H, L_Q, index, scores, device=paddle.device.get_device(), base=mask_base)
             # scores.masked_fill_(attn_mask.mask, -np.inf)
-            scores = paddle.where(attn_mask.mask, -np.inf*paddle.ones_like(scores), scores)
+            scores = paddle.where(attn_mask.mask, paddle.full([], -np.inf, dtype=scores.dtype), scores)
         attn = F.softmax(scores, axis=-1) # nn.Softmax(dim=-1)(scores)
 
-        context_in[paddle.arange(B)[:, None, None],
-                   paddle.arange(H)[None, :, None],
-                   index, :] = paddle.matmul(attn, V).cast(context_in.dtype)
+        # write the top-k rows back along the query axis, index [B, H, u] -> [B, H, u, 1]
+        index = index.unsqueeze(-1)
+        context_in = paddle.put_along_axis(context_in, index, _matmul(attn, V, self.amp_dtype), axis=2)
         if self.output_attention:
-            attns = (paddle.ones([B, H, L_V, L_V])/L_V).cast(attn.dtype)#.to(attn.device)
-            attns[paddle.arange(B)[:, None, None], paddle.arange(H)[None, :, None], index, :] = attn
+            attns = paddle.full([B, H, L_V, L_V], 1./L_V, dtype=attn.dtype)
+            attns = paddle.put_along_axis(attns, index, attn, axis=2)
             return (context_in, attns)
         else:
             return (context_in, None)
 
     def forward(self, queries, keys, values, attn_mask):
-        B, L_Q, H, D = queries.shape
-        _, L_K, _, _ = keys.shape
+        # queries [B, H, L_Q, D], keys/values [B, H, L_K, D]
+        B, H, L_Q, D = queries.shape
+        _, _, L_K, _ = keys.shape
 
-        queries = queries.transpose(swap_shape(queries, 2,1))
-        keys = keys.transpose(swap_shape(keys, 2,1))
-        values = values.transpose(swap_shape(values, 2,1))
-
-        U_part = self.factor * np.ceil(np.log(L_K)).astype('int').item() # c*ln(L_k)
-        u = self.factor * np.ceil(np.log(L_Q)).astype('int').item() # c*ln(L_q)
+        U_part = self.factor * ceil(log(L_K)) # c*ln(L_k)
+        u = self.factor * ceil(log(L_Q)) # c*ln(L_q)
 
         U_part = U_part if U_part<L_K else L_K
         u = u if u<L_Q else L_Q
 
-        scores_top, index = self._prob_QK(queries, keys, sample_k=U_part, n_top=u)
-
         # add scale factor
         scale = self.scale or 1./sqrt(D)
-        if scale is not None:
-            scores_top = scores_top * scale
+        scores_top, index = self._prob_QK(queries, keys, sample_k=U_part, n_top=u, scale=scale)
+
         # get the context
         context = self._get_initial_context(values, L_Q)
         # update the context with selected top_k queries
         context, attn = self._update_context(context, values, scores_top, index, L_Q, attn_mask)
 
-        return context.transpose(swap_shape(context, 2,1)), attn
+        return context, attn
 
 
 class AttentionLayer(nn.Layer):
@@ -140,8 +182,12 @@ class AttentionLayer(nn.Layer):
 
         self.inner_attention = attention
         self.query_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.key_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.value_projection = nn.Linear(d_model, d_values * n_heads)
+        # keys and values are projected together, [d_model, k+v]
+        self.kv_dims = [d_keys * n_heads, d_values * n_heads]
+        self.kv_projection = nn.Linear(d_model, sum(self.kv_dims))
+        # init each half like its own nn.Linear(d_model, dim)
+        self.kv_projection.weight.set_value(paddle.concat(
+            [xavier_uniform([d_model, dim]) for dim in self.kv_dims], axis=-1))
         self.out_projection = nn.Linear(d_values * n_heads, d_model)
         self.n_heads = n_heads
         self.mix = mix
@@ -151,9 +197,24 @@ class AttentionLayer(nn.Layer):
         _, S, _ = keys.shape
         H = self.n_heads
 
-        queries = self.query_projection(queries).reshape([B, L, H, -1])
-        keys = self.key_projection(keys).reshape([B, S, H, -1])
-        values = self.value_projection(values).reshape([B, S, H, -1])
+        queries = self.query_projection(queries)
+        if keys is values:
+            # self-attention and the decoder's cross-attention: one GEMM for k and v
+            keys, values = paddle.split(self.kv_projection(keys), self.kv_dims, axis=-1)
+        else:
+            weight_k, weight_v = paddle.split(self.kv_projection.weight, self.kv_dims, axis=-1)
+            bias_k, bias_v = paddle.split(self.kv_projection.bias, self.kv_dims, axis=-1)
+            keys = F.linear(keys, weight_k, bias_k)
+            values = F.linear(values, weight_v, bias_v)
+
+        queries = queries.reshape([B, L, H, -1])
+        keys = keys.reshape([B, S, H, -1])
+        values = values.reshape([B, S, H, -1])
+        heads_first = getattr(self.inner_attention, 'heads_first', False)
+        if heads_first:
+            queries = queries.transpose([0, 2, 1, 3])
+            keys = keys.transpose([0, 2, 1, 3])
+            values = values.transpose([0, 2, 1, 3])
 
         out, attn = self.inner_attention(
             queries,
@@ -161,8 +222,19 @@ class AttentionLayer(nn.Layer):
             values,
             attn_mask
         )
-        if self.mix:
-            out = out.transpose(swap_shape(out, 2,1))#.contiguous()
+        # out is [B, H, L, D] for heads-first attentions, else [B, L, H, D];
+        # mix flattens in heads-first order
+        if self.mix != heads_first:
+            out = out.transpose([0, 2, 1, 3])
         out = out.reshape([B, L, -1])
 
         return self.out_projection(out), attn
+
+    def _upgrade_state_dict(self, state_dict, prefix):
+        # checkpoints from before kv_projection have separate key/value projections
+        for p in ['weight', 'bias']:
+            k, v = prefix + 'key_projection.' + p, prefix + 'value_projection.' + p
+            if k in state_dict and v in state_dict:
+                state_dict[prefix + 'kv_projection.' + p] = np.concatenate(
+                    [np.asarray(state_dict.pop(k)), np.asarray(state_dict.pop(v))], axis=-1)
+
@@ -3,21 +3,24 @@ import paddle.nn as nn
 import paddle.nn.functional as F
 
 import math
-from ..utils.tools import swap_shape
+import numpy as np
+from ..utils.tools import xavier_uniform
+
+def _sinusoid_table(n, d_model):
+    # Compute the positional encodings once in log space.
+    position = paddle.arange(0, n).astype('float32').unsqueeze(1)
+    div_term = (paddle.arange(0, d_model, 2).astype('float32') * -(math.log(10000.0) / d_model)).exp()
+
+    # interleave sin/cos as [n, d/2, 2] -> [n, d]: w[:, 0::2] = sin, w[:, 1::2] = cos
+    return paddle.stack([paddle.sin(position * div_term),
+                         paddle.cos(position * div_term)], axis=-1).reshape([n, d_model])
 
 class PositionalEmbedding(nn.Layer):
     def __init__(self, d_model, max_len=5000):
         super(PositionalEmbedding, self).__init__()
-        # Compute the positional encodings once in log space.
-        pe = paddle.zeros([max_len, d_model]).astype('float')
+        pe = _sinusoid_table(max_len, d_model)
         pe.stop_gradient = True
 
-        position = paddle.arange(0, max_len).astype('float').unsqueeze(1)
-        div_term = (paddle.arange(0, d_model, 2).astype('float') * -(math.log(10000.0) / d_model)).exp()
-
-        pe[:, 0::2] = paddle.sin(position * div_term)
-        pe[:, 1::2] = paddle.cos(position * div_term)
-
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
@@ -29,36 +32,29 @@ class TokenEmbedding(nn.Layer):
         super(TokenEmbedding, self).__init__()
         # padding = 1 if paddle.__version__>='1.5.0' else 2
         padding = 1
+        # channels-last conv: takes and returns [B, L, C], no transposes around it
         self.tokenConv = nn.Conv1D(in_channels=c_in,            out_channels=d_model,
                                     kernel_size=3, padding=padding, padding_mode='circular',
-                                    weight_attr=nn.initializer.KaimingNormal())
+                                    weight_attr=nn.initializer.KaimingNormal(), data_format='NLC')
         # for m in self.sublayers():
         #     if isinstance(m, nn.Conv1D):
         #         nn.init.kaiming_normal_(m.weight,mode='fan_in',nonlinearity='leaky_relu')
 
     def forward(self, x):
-        x = self.tokenConv(x.transpose([0, 2, 1]))
-        x = x.transpose(swap_shape(x, 1,2))
-        return x
+        return self.tokenConv(x)
 
 class FixedEmbedding(nn.Layer):
     def __init__(self, c_in, d_model):
         super(FixedEmbedding, self).__init__()
 
-        w = paddle.zeros([c_in, d_model]).astype('float')
-        w.stop_gradient = True
-
-        position = paddle.arange(0, c_in).astype('float').unsqueeze(1)
-        div_term = (paddle.arange(0, d_model, 2).astype('float') * -(math.log(10000.0) / d_model)).exp()
-
-        w[:, 0::2] = paddle.sin(position * div_term)
-        w[:, 1::2] = paddle.cos(position * div_term)
+        w = _sinusoid_table(c_in, d_model)
 
+        # frozen sinusoidal table, the weight has stop_gradient set so no detach is needed
         self.emb = nn.Embedding(c_in, d_model, weight_attr=paddle.ParamAttr(trainable=False))
-        # self.emb.weight = nn.Parameter(w, requires_grad=False)
+        self.emb.weight.set_value(w)
 
     def forward(self, x):
-        return self.emb(x).detach()
+        return self.emb(x)
 
 class TemporalEmbedding(nn.Layer):
     def __init__(self, d_model, embed_type='fixed', freq='h'):
@@ -67,24 +63,37 @@ class TemporalEmbedding(nn.Layer):
         minute_size = 4; hour_size = 24
         weekday_size = 7; day_size = 32; month_size = 13
 
-        Embed = FixedEmbedding if embed_type=='fixed' else nn.Embedding
+        # x_mark columns: month, day, weekday, hour(, minute)
+        self.fields = ['month', 'day', 'weekday', 'hour']
+        sizes = [month_size, day_size, weekday_size, hour_size]
         if freq=='t':
-            self.minute_embed = Embed(minute_size, d_model)
-        self.hour_embed = Embed(hour_size, d_model)
-        self.weekday_embed = Embed(weekday_size, d_model)
-        self.day_embed = Embed(day_size, d_model)
-        self.month_embed = Embed(month_size, d_model)
+            self.fields.append('minute')
+            sizes.append(minute_size)
+
+        # all fields share one table; field i looks up rows offsets[i]:offsets[i]+sizes[i].
+        # each slice is built like the per-field FixedEmbedding / nn.Embedding table
+        if embed_type=='fixed':
+            tables = [_sinusoid_table(size, d_model) for size in sizes]
+        else:
+            tables = [xavier_uniform([size, d_model]) for size in sizes]
+        self.embed = nn.Embedding(sum(sizes), d_model, weight_attr=paddle.ParamAttr(trainable=embed_type!='fixed'))
+        self.embed.weight.set_value(paddle.concat(tables, axis=0))
+        self.register_buffer('offsets', paddle.to_tensor(np.cumsum([0] + sizes[:-1]), dtype='int64'), persistable=False)
 
     def forward(self, x):
-        x = x.astype('int64')
-
-        minute_x = self.minute_embed(x[:,:,4]) if hasattr(self, 'minute_embed') else 0.
-        hour_x = self.hour_embed(x[:,:,3])
-        weekday_x = self.weekday_embed(x[:,:,2])
-        day_x = self.day_embed(x[:,:,1])
-        month_x = self.month_embed(x[:,:,0])
-
-        return hour_x + weekday_x + day_x + month_x + minute_x
+        x = x[:, :, :len(self.offsets)].astype('int64') + self.offsets
+
+        # [B, L, K] -> [B, L, K, d_model], one gather for all fields
+        return self.embed(x).sum(axis=2)
+
+    def _upgrade_state_dict(self, state_dict, prefix):
+        # checkpoints from before the shared table have one month_embed, day_embed, ... per field
+        # ('<field>_embed.weight', or '<field>_embed.emb.weight' for embed_type='fixed')
+        for suffix in ['_embed.weight', '_embed.emb.weight']:
+            keys = [prefix + f + suffix for f in self.fields]
+            if all(k in state_dict for k in keys):
+                state_dict[prefix + 'embed.weight'] = np.concatenate(
+                    [np.asarray(state_dict.pop(k)) for k in keys], axis=0)
 
 class TimeFeatureEmbedding(nn.Layer):
     def __init__(self, d_model, embed_type='timeF', freq='h'):
@@ -10,13 +10,17 @@ class TriangularCausalMask():
     def mask(self):
         return self._mask
 
+def prob_mask_base(L, S):
+    # the [L, S] upper-triangular mask every ProbMask takes its rows from
+    return paddle.ones([L, S], dtype="bool").triu(1)
+
 class ProbMask():
-    def __init__(self, B, H, L, index, scores, device="cpu"):
-        _mask = paddle.ones([L, scores.shape[-1]], dtype="bool").triu(1)#.to(device).triu(1)
-        _mask_ex = _mask[None, None, :].expand([B, H, L, scores.shape[-1]])
-        indicator = _mask_ex[paddle.arange(B)[:, None, None],
-                             paddle.arange(H)[None, :, None],
-                             index, :]#.to(device)
+    def __init__(self, B, H, L, index, scores, device="cpu", base=None):
+        # base: a prob_mask_base(L, S) to reuse across calls, built here if not given
+        if base is None:
+            base = prob_mask_base(L, scores.shape[-1])
+        # rows of the selected top-k queries, [B, H, u, S]
+        indicator = paddle.index_select(base, index.reshape([-1]), axis=0)#.to(device)
         self._mask = indicator.reshape(scores.shape)#.to(device)
 
     @property
@@ -83,4 +83,19 @@ def swap_shape(data, dim0, dim1):
     dim1 = (dim1 + len(shape)) if dim1 < 0 else dim1
     perm[dim0] = dim1
     perm[dim1] = dim0
-    return perm
\ No newline at end of file
+    return perm
+
+
+def xavier_uniform(shape):
+    # a tensor initialised like a standalone nn.Linear / nn.Embedding weight of this shape
+    w = paddle.empty(shape)
+    paddle.nn.initializer.XavierUniform()(w)
+    return w
+
+def upgrade_state_dict(model, state_dict):
+    """rewrite a checkpoint saved with older parameter names for the layers of model"""
+    state_dict = dict(state_dict)
+    for name, layer in model.named_sublayers():
+        if hasattr(layer, '_upgrade_state_dict'):
+            layer._upgrade_state_dict(state_dict, name + '.')
+    return state_dict